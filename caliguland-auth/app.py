@@ -1,94 +1,219 @@
-from fastapi import FastAPI, HTTPException, Response, Cookie, Form
+from fastapi import FastAPI, HTTPException, Request, Response, Cookie, Form, Header
 from fastapi.responses import HTMLResponse, RedirectResponse
+import anyio
+import anyio.to_thread
 from pydantic import BaseModel
-import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
 import jwt
+import hashlib
+import hmac
+import base64
+import json
+import functools
+import time
 import httpx
 import os
-from datetime import datetime, timedelta
+import sys
+import atexit
+import queue
+import logging
+import logging.handlers
 from dstack_sdk import DstackClient
+from cachetools import TTLCache
+
+# Log through a queue so handlers only enqueue; a background thread does the
+# blocking writes to stdout
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger("caliguland-auth")
+# Unknown LOG_LEVEL values fall back to INFO rather than failing startup
+_log_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+log.setLevel(_log_level if isinstance(_log_level, int) else logging.INFO)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.propagate = False
 
 app = FastAPI()
 
 # Trust proxy headers to fix redirect port issues
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.datastructures import Headers
 import re
 
-class ProxyHeadersMiddleware(BaseHTTPMiddleware):
-    """Middleware to respect X-Forwarded-* headers and fix redirect ports"""
-    async def dispatch(self, request, call_next):
-        # Get forwarded host (without port)
-        forwarded_host = request.headers.get("x-forwarded-host")
-        forwarded_proto = request.headers.get("x-forwarded-proto")
+# Matches (scheme)://(domain):port(/path) so the port can be stripped from redirects
+_REDIRECT_PORT_RE = re.compile(rb'(https?://[^/:]+):\d+(/.*)')
+
+class ProxyHeadersMiddleware:
+    """Middleware to respect X-Forwarded-* headers and fix redirect ports
+
+    Implemented as plain ASGI rather than BaseHTTPMiddleware to avoid the
+    extra task group and memory streams it wraps around every request.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        raw_headers = scope["headers"]
+        forwarded_host = forwarded_proto = host_index = None
+        for i, (key, value) in enumerate(raw_headers):
+            if key == b"x-forwarded-host":
+                forwarded_host = value
+            elif key == b"x-forwarded-proto":
+                forwarded_proto = value
+            elif key == b"host":
+                host_index = i
 
         if forwarded_host:
             # Replace Host header with X-Forwarded-Host (strips port)
-            headers = dict(request.headers)
-            headers["host"] = forwarded_host
-            request._headers = Headers(headers)
-            request.scope["headers"] = [(k.encode(), v.encode()) for k, v in headers.items()]
+            if host_index is None:
+                raw_headers.append((b"host", forwarded_host))
+            else:
+                raw_headers[host_index] = (b"host", forwarded_host)
 
         if forwarded_proto:
-            request.scope["scheme"] = forwarded_proto
-
-        response = await call_next(request)
-
-        # Strip port from Location header in redirects (if present)
-        if "location" in response.headers:
-            location = response.headers["location"]
-            # Remove :port from URLs like https://domain:6666/path -> https://domain/path
-            # Pattern matches: (scheme)://(domain):port(/path)
-            fixed_location = re.sub(r'(https?://[^/:]+):\d+(/.*)', r'\1\2', location)
-            if fixed_location != location:
-                response.headers["location"] = fixed_location
-                print(f"🔧 Fixed redirect: {location} -> {fixed_location}")
-
-        return response
+            scope["scheme"] = forwarded_proto.decode("latin-1")
+
+        async def send_with_fixed_location(message):
+            # Strip port from Location header in redirects (if present)
+            if message["type"] == "http.response.start":
+                headers = message["headers"]
+                for i, (key, value) in enumerate(headers):
+                    if key == b"location":
+                        # Remove :port from URLs like https://domain:6666/path -> https://domain/path
+                        fixed_location = _REDIRECT_PORT_RE.sub(rb'\1\2', value)
+                        if fixed_location != value:
+                            headers = list(headers)
+                            headers[i] = (b"location", fixed_location)
+                            message["headers"] = headers
+                            if log.isEnabledFor(logging.DEBUG):
+                                log.debug("🔧 Fixed redirect: %s -> %s", value.decode("latin-1"), fixed_location.decode("latin-1"))
+                        break
+            await send(message)
+
+        await self.app(scope, receive, send_with_fixed_location)
 
 app.add_middleware(ProxyHeadersMiddleware)
 
 # Configuration from environment
 USERNAME = os.getenv("VIBEVM_USERNAME", "admin")
+_USERNAME_BYTES = USERNAME.encode()
 VIBEVM_PASSWORD = os.getenv("VIBEVM_PASSWORD")
 
 if not VIBEVM_PASSWORD:
-    print("❌ ERROR: VIBEVM_PASSWORD must be set")
+    log.error("❌ ERROR: VIBEVM_PASSWORD must be set")
     raise ValueError("Missing password configuration: VIBEVM_PASSWORD is required")
 
-# Hash password automatically and store as bytes
-PASSWORD_HASH_BYTES = bcrypt.hashpw(VIBEVM_PASSWORD.encode(), bcrypt.gensalt())
-print("✅ Password automatically hashed from VIBEVM_PASSWORD")
+# Hash password automatically with Argon2id
+_ph = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=1)
+PASSWORD_HASH = _ph.hash(VIBEVM_PASSWORD)
+log.info("✅ Password automatically hashed from VIBEVM_PASSWORD")
+
+# Each Argon2id verify holds memory_cost (64 MiB) for its duration, so cap how
+# many run at once; peak KDF memory is KDF_CONCURRENCY x 64 MiB
+KDF_CONCURRENCY = int(os.getenv("KDF_CONCURRENCY", "2"))
+
+@functools.lru_cache(maxsize=1)
+def get_kdf_limiter() -> anyio.CapacityLimiter:
+    """Shared limiter for password verifies (created lazily: needs a running event loop)"""
+    return anyio.CapacityLimiter(KDF_CONCURRENCY)
+
+# Verified against on unknown usernames so every login attempt costs one KDF run
+_DUMMY_HASH = _ph.hash(os.urandom(16).hex())
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """Check password against an Argon2id hash, treating any error as a mismatch"""
+    try:
+        return _ph.verify(password_hash, password)
+    except VerifyMismatchError:
+        return False
+    except Exception as e:
+        log.error("❌ Auth error: %s", e)
+        return False
+
+# Per-IP token buckets for /login: bursts of LOGIN_BURST attempts, refilled at
+# LOGIN_RATE per second, so each client IP is held to about LOGIN_RATE
+# KDF runs per second
+LOGIN_RATE = float(os.getenv("LOGIN_RATE", "1"))
+LOGIN_BURST = float(os.getenv("LOGIN_BURST", "5"))
+_buckets = TTLCache(maxsize=50000, ttl=300)
+
+def take_login_token(ip: str) -> bool:
+    """Consume one login attempt from ip's bucket; False if it is empty"""
+    now = time.monotonic()
+    tokens, last = _buckets.get(ip, (LOGIN_BURST, now))
+    tokens = min(LOGIN_BURST, tokens + (now - last) * LOGIN_RATE)
+    if tokens < 1:
+        _buckets[ip] = (tokens, now)
+        return False
+    _buckets[ip] = (tokens - 1, now)
+    return True
 
 JWT_EXPIRY_HOURS = int(os.getenv("JWT_EXPIRY_HOURS", "24"))
+_JWT_EXPIRY_SECONDS = JWT_EXPIRY_HOURS * 3600
 JWT_PURPOSE = os.getenv("JWT_PURPOSE", "caliguland-session")
 JWT_KEY_PATH = os.getenv("JWT_KEY_PATH", "caliguland/auth/signing")
 
-# Cache for JWT signing key
-_jwt_secret = None
-
-def get_jwt_secret() -> str:
-    """Derive JWT signing key from Dstack TEE"""
-    global _jwt_secret
-    if _jwt_secret:
-        return _jwt_secret
-
+# JWT header never changes, so serialize and base64url-encode it once
+_JWT_HEADER_B64 = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+
+# Session tokens only carry sub/iat/exp/purpose, so skip PyJWT's other claim
+# checks and have it enforce that the claims we read are present
+_DECODE_OPTS = {
+    "verify_aud": False,
+    "verify_iss": False,
+    "verify_nbf": False,
+    "verify_iat": False,
+    "require": ["exp", "sub", "purpose"],
+}
+
+# Cache of recently validated sessions, keyed by a SHA-256 prefix of the token
+# (never the raw token) and holding (exp, user) so expiry is still honoured
+_tok_cache = TTLCache(maxsize=10000, ttl=30)
+
+@functools.lru_cache(maxsize=1)
+def get_dstack_client() -> DstackClient:
+    """Shared Dstack client, so its underlying httpx client is reused"""
+    return DstackClient()
+
+@functools.lru_cache(maxsize=1)
+def get_jwt_secret() -> bytes:
+    """Derive JWT signing key from Dstack TEE (cached after first success)"""
     try:
         # Use Dstack to derive a deterministic key
-        dstack = DstackClient()
-        response = dstack.get_key(path=JWT_KEY_PATH)
+        response = get_dstack_client().get_key(path=JWT_KEY_PATH)
         # Extract the actual key string from the response object
-        _jwt_secret = response.key if hasattr(response, 'key') else response['key']
-        print(f"✅ JWT key derived from Dstack TEE at path: {JWT_KEY_PATH}")
-        return _jwt_secret
+        jwt_secret = response.key if hasattr(response, 'key') else response['key']
+        log.info("✅ JWT key derived from Dstack TEE at path: %s", JWT_KEY_PATH)
+        # Keep the key as bytes so HS256 sign/verify hands it straight to
+        # hmac (OpenSSL) without re-encoding on every call
+        return jwt_secret.encode()
     except Exception as e:
-        print(f"❌ Error deriving JWT key: {e}")
+        log.error("❌ Error deriving JWT key: %s", e)
         raise HTTPException(status_code=500, detail="Failed to derive JWT key")
 
-@app.get("/login", response_class=HTMLResponse)
-async def login_page():
-    """Serve login page"""
-    html = """
+def encode_jwt(payload: dict) -> str:
+    """Sign payload as an HS256 JWT using the pre-serialized header"""
+    payload_b64 = base64.urlsafe_b64encode(
+        json.dumps(payload, separators=(",", ":")).encode()
+    ).rstrip(b"=")
+    signing_input = _JWT_HEADER_B64 + b"." + payload_b64
+    signature = hmac.new(get_jwt_secret(), signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + base64.urlsafe_b64encode(signature).rstrip(b"=")).decode()
+
+# Derive the key eagerly so the first request doesn't pay the TEE round-trip;
+# failures aren't cached, so a request will retry if Dstack isn't up yet
+try:
+    get_jwt_secret()
+except HTTPException:
+    pass
+
+# Login page is static, so encode it once and let browsers revalidate via ETag
+_LOGIN_HTML_BYTES = ("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -209,44 +334,74 @@ async def login_page():
         </div>
     </body>
     </html>
-    """
-    return HTMLResponse(content=html)
+    """).encode("utf-8")
+_LOGIN_ETAG = '"' + hashlib.sha256(_LOGIN_HTML_BYTES).hexdigest()[:16] + '"'
+_LOGIN_HEADERS = {
+    "content-type": "text/html; charset=utf-8",
+    "cache-control": "public, max-age=3600",
+    "etag": _LOGIN_ETAG,
+}
+# A 304 carries the same validators/freshness headers as the 200 would
+_LOGIN_NOT_MODIFIED_HEADERS = {
+    "cache-control": _LOGIN_HEADERS["cache-control"],
+    "etag": _LOGIN_ETAG,
+}
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak If-None-Match comparison: handles `*`, lists and W/ prefixes"""
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+@app.get("/login", response_class=HTMLResponse)
+async def login_page(if_none_match: str = Header(None)):
+    """Serve login page"""
+    if if_none_match and etag_matches(if_none_match, _LOGIN_ETAG):
+        return Response(status_code=304, headers=_LOGIN_NOT_MODIFIED_HEADERS)
+    return Response(content=_LOGIN_HTML_BYTES, headers=_LOGIN_HEADERS)
 
 @app.post("/login")
 async def login(
+    request: Request,
     username: str = Form(...),
-    password: str = Form(...),
-    response: Response = None
+    password: str = Form(...)
 ):
     """Validate credentials and issue JWT"""
-    from fastapi import Request
-
-    # Validate username
-    if username != USERNAME:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-
-    # Validate password against bcrypt hash
-    try:
-        if not bcrypt.checkpw(password.encode(), PASSWORD_HASH_BYTES):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-    except Exception as e:
-        print(f"❌ Auth error: {e}")
+    # Throttle per client IP before doing any KDF work (fail open if unknown).
+    # uvicorn's proxy_headers already resolves X-Forwarded-For from the peers
+    # in FORWARDED_ALLOW_IPS into request.client.
+    ip = request.client.host if request.client else ""
+    if ip and not take_login_token(ip):
+        raise HTTPException(status_code=429, detail="Too many login attempts", headers={"Retry-After": "1"})
+
+    # Compare the username in constant time and always run the password check
+    # (against a dummy hash on a miss) so timing doesn't reveal valid usernames.
+    # The KDF runs in a worker thread so it doesn't stall the event loop, with
+    # concurrency bounded by the KDF limiter.
+    user_ok = hmac.compare_digest(username.encode(), _USERNAME_BYTES)
+    pw_ok = await anyio.to_thread.run_sync(
+        verify_password,
+        PASSWORD_HASH if user_ok else _DUMMY_HASH,
+        password,
+        limiter=get_kdf_limiter()
+    )
+    if not (user_ok and pw_ok):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     # Generate JWT token
-    expiry = datetime.utcnow() + timedelta(hours=JWT_EXPIRY_HOURS)
-    token = jwt.encode(
-        {
-            "sub": username,
-            "exp": expiry,
-            "iat": datetime.utcnow(),
-            "purpose": JWT_PURPOSE
-        },
-        get_jwt_secret(),
-        algorithm="HS256"
-    )
+    now = int(time.time())
+    token = encode_jwt({
+        "sub": username,
+        "iat": now,
+        "exp": now + _JWT_EXPIRY_SECONDS,
+        "purpose": JWT_PURPOSE
+    })
 
-    print(f"✅ Login successful: {username}")
+    log.info("✅ Login successful: %s", username)
 
     # Set HttpOnly cookie and redirect (use relative path to avoid port issues)
     response = RedirectResponse(url="/code-server", status_code=302)
@@ -256,39 +411,70 @@ async def login(
         httponly=True,
         secure=False,  # Set to True in production with HTTPS
         samesite="lax",
-        max_age=JWT_EXPIRY_HOURS * 3600
+        max_age=_JWT_EXPIRY_SECONDS
     )
     return response
 
+def _unauthorized(detail: str) -> Response:
+    """Pre-built 401 with the same body FastAPI renders for HTTPException"""
+    return Response(
+        status_code=401,
+        content=json.dumps({"detail": detail}, separators=(",", ":")).encode(),
+        media_type="application/json"
+    )
+
+# nginx hits /auth/validate on every proxied request, so the common rejections
+# are returned directly instead of raising HTTPException
+_NO_SESSION_RESP = _unauthorized("No session cookie")
+_BAD_PURPOSE_RESP = _unauthorized("Invalid token purpose")
+_EXPIRED_RESP = _unauthorized("Session expired")
+
 @app.get("/auth/validate")
 async def validate(vibevm_session: str = Cookie(None)):
     """Validate JWT token (called by nginx auth_request)"""
 
     if not vibevm_session:
-        raise HTTPException(status_code=401, detail="No session cookie")
+        return _NO_SESSION_RESP
+
+    key = hashlib.sha256(vibevm_session.encode()).digest()[:16]
+    cached = _tok_cache.get(key)
+    if cached:
+        exp, user = cached
+        if exp > int(time.time()):
+            return {"status": "valid", "user": user}
+        _tok_cache.pop(key, None)
 
     try:
         payload = jwt.decode(
             vibevm_session,
             get_jwt_secret(),
-            algorithms=["HS256"]
+            algorithms=["HS256"],
+            options=_DECODE_OPTS
         )
 
-        # Validate purpose
-        if payload.get("purpose") != JWT_PURPOSE:
-            raise HTTPException(status_code=401, detail="Invalid token purpose")
+        # Validate purpose (presence is enforced by _DECODE_OPTS)
+        if payload["purpose"] != JWT_PURPOSE:
+            return _BAD_PURPOSE_RESP
 
-        return {"status": "valid", "user": payload["sub"]}
+        user = payload["sub"]
+        _tok_cache[key] = (payload["exp"], user)
+        return {"status": "valid", "user": user}
 
     except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Session expired")
+        return _EXPIRED_RESP
     except jwt.InvalidTokenError as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
 
+# Health payload never changes, so build the response once
+_HEALTH_RESPONSE = Response(
+    content=b'{"status":"healthy","service":"caliguland-auth"}',
+    media_type="application/json"
+)
+
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "caliguland-auth"}
+    return _HEALTH_RESPONSE
 
 @app.get("/logout")
 async def logout():